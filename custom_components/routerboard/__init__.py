@@ -1,38 +1,101 @@
 """RouterBoard client API."""
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from time import sleep
+from functools import lru_cache
+from time import monotonic, monotonic_ns
 
+import asyncio
 import logging
 import ipaddress
+import random
+import socket
+import struct
+import threading
 import voluptuous as vol
 
-from homeassistant.const import (
-    CONF_HOST, CONF_NAME, CONF_USERNAME, CONF_PASSWORD, CONF_PORT, CONF_SCAN_INTERVAL)
+from homeassistant.const import CONF_HOST, CONF_NAME, CONF_USERNAME, CONF_PASSWORD, CONF_PORT, CONF_SCAN_INTERVAL
 from homeassistant.helpers import config_validation as cv, discovery
-from homeassistant.helpers.dispatcher import dispatcher_send
-from homeassistant.helpers.event import track_time_interval
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator
+from homeassistant.util import slugify
 
 
 _LOGGER = logging.getLogger(__name__)
 
 
+# Called from entity properties and setup with the same few configured addresses, parse each string once
+@lru_cache(maxsize=4096)
 def _is_address_a_network(address):
-    try:
+    # Only networks have a prefix, parsing just validates and raises ValueError on invalid input
+    if '/' not in address:
         ipaddress.IPv4Address(address)
         return False
-    except ipaddress.AddressValueError:
+    ipaddress.IPv4Network(address)
+    return True
+
+
+def _split_monitored_addresses(addresses):
+    # Validate and classify monitored addresses once, returns (valid addresses in configured order, networks)
+    valid_addresses = []
+    networks = []
+    for address in addresses:
         try:
-            ipaddress.IPv4Network(address)
-            return True
-        except Exception:
-            raise
+            if _is_address_a_network(address):
+                networks.append(address)
+            valid_addresses.append(address)
+        except (TypeError, ValueError):
+            _LOGGER.warning(f"Invalid address [{address}] specified. "
+                            f"IPv4 address (192.168.1.1) or IPv4 network (192.168.1.0/24) supported only")
+    return valid_addresses, networks
+
+
+_unpack_address = struct.Struct('!I').unpack
+
+
+def _address_to_int(address):
+    # Called twice for every accounting row, format is precompiled above
+    return _unpack_address(socket.inet_aton(address))[0]
+
+
+def _generate_entity_id(entity_id_format, name, current_ids):
+    # Same ids as async_generate_entity_id, but checked against a set of existing ids collected once per platform
+    # setup. Every generated id is reserved so entities created in the same batch don't collide
+    preferred_id = entity_id_format.format(slugify(name.lower()))
+    entity_id = preferred_id
+    tries = 1
+    while entity_id in current_ids:
+        tries += 1
+        entity_id = f'{preferred_id}_{tries}'
+    current_ids.add(entity_id)
+    return entity_id
+
+
+def _validate_intervals(conf):
+    # Default bounds never clamp explicitly configured scan interval
+    conf.setdefault(CONF_MIN_INTERVAL, min(DEFAULT_MIN_INTERVAL, conf[CONF_SCAN_INTERVAL]))
+    conf.setdefault(CONF_MAX_INTERVAL, max(DEFAULT_MAX_INTERVAL, conf[CONF_SCAN_INTERVAL]))
+    if conf[CONF_MIN_INTERVAL] > conf[CONF_MAX_INTERVAL]:
+        raise vol.Invalid(f"{CONF_MIN_INTERVAL} can't be greater than {CONF_MAX_INTERVAL}")
+    return conf
+
+
+def _is_connection_error(error):
+    from librouteros.exceptions import ConnectionError, FatalError
+
+    # FatalError means router closed the session, socket errors may surface unwrapped
+    return isinstance(error, (ConnectionError, FatalError, OSError))
 
 
 CONST_SENSOR_NETWORK = 1
 
+SECTION_HOSTS = 'hosts'
+SECTION_ACCOUNTING = 'accounting'
+SECTION_QUEUES = 'queues'
+
 DOMAIN = 'routerboard'
-DATA_UPDATED = 'routerboard_data_updated'
 DATA_ROUTERBOARD = 'data_routerboard'
+DATA_COORDINATOR = 'data_routerboard_coordinator'
 
 DEFAULT_NAME = 'RouterBoard'
 DEFAULT_USERNAME = 'api_read'
@@ -42,16 +105,39 @@ DEFAULT_PORT = 8728
 AVAILABLE_TRAFFIC_UNITS = ['b/s', 'B/s', 'Kb/s', 'KB/s', 'Mb/s', 'MB/s']
 AVAILABLE_MONITORED_TRAFFIC = ['active', 'download', 'upload', 'local', 'wan']
 
+# Unit prefix (first letter of traffic unit) to (divisor, rounding digits)
+TRAFFIC_UNIT_PREFIXES = {'K': (1000, 1), 'M': (1000000, 2)}
+# Queue limit units as (threshold, unit), largest first
+BITS_UNITS = ((1000000, 'Mbits/s'), (1000, 'kbits/s'))
+
 CONF_TRAFFIC_UNIT = 'traffic_unit'
 CONF_EXPAND_NETWORK_HOSTS = 'expand_network_hosts'
 CONF_MONITORED_ADDRESSES = 'monitored_addresses'
 CONF_MONITORED_TRAFFIC = 'monitored_traffic'
 CONF_MANAGE_QUEUES = 'manage_queues'
+CONF_HOSTS_REFRESH_UPDATES = 'hosts_refresh_updates'
 CONF_CUSTOM_SWITCHES = 'custom_switches'
+CONF_MIN_INTERVAL = 'min_interval'
+CONF_MAX_INTERVAL = 'max_interval'
+CONF_TURN_ON = 'turn_on'
+CONF_TURN_OFF = 'turn_off'
+CONF_STATE = 'state'
+CONF_CMD = 'cmd'
+CONF_ARGS = 'args'
 
 DEFAULT_TRAFFIC_UNIT = 'Mb/s'
 
 DEFAULT_SCAN_INTERVAL = timedelta(seconds=30)
+DEFAULT_MIN_INTERVAL = timedelta(seconds=5)
+DEFAULT_MAX_INTERVAL = timedelta(minutes=5)
+DEFAULT_HOSTS_REFRESH_UPDATES = 10  # Updates between DHCP lease fetches
+
+SCAN_INTERVAL_JITTER = 0.1  # Fraction of interval
+SCAN_INTERVAL_BACKOFF_RATIO = 0.5  # Back off if update takes longer than this fraction of interval
+
+COMMAND_LOCK_TIMEOUT = 1  # Seconds
+RECONNECT_BACKOFF_MIN = 1  # Seconds
+RECONNECT_BACKOFF_MAX = 30  # Seconds
 
 SERVICE_COMMAND_NAME = "run_script"
 
@@ -59,45 +145,64 @@ SERVICE_SCHEMA = vol.Schema({
     vol.Required(CONF_NAME): cv.string
 })
 
-try:
-    CONFIG_SCHEMA = vol.Schema({
-        DOMAIN: vol.Schema({
-            vol.Required(CONF_HOST): cv.string,
-            vol.Optional(CONF_USERNAME, default=DEFAULT_USERNAME): cv.string,
-            vol.Optional(CONF_PASSWORD, default=DEFAULT_PASSWORD): cv.string,
-            vol.Optional(CONF_PORT, default=DEFAULT_PORT): cv.port,
-            vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
-            vol.Optional(CONF_SCAN_INTERVAL, default=DEFAULT_SCAN_INTERVAL): cv.time_period,
-            vol.Optional(CONF_TRAFFIC_UNIT, default=DEFAULT_TRAFFIC_UNIT): vol.In(AVAILABLE_TRAFFIC_UNITS),
-            vol.Optional(CONF_EXPAND_NETWORK_HOSTS, default=False): cv.boolean,
-            vol.Optional(CONF_MONITORED_TRAFFIC, default=['active']): vol.All(cv.ensure_list, [vol.In(AVAILABLE_MONITORED_TRAFFIC)]),
-            vol.Optional(CONF_EXPAND_NETWORK_HOSTS, default=False): cv.boolean,
-            vol.Optional(CONF_MONITORED_ADDRESSES, default=[]): vol.All(),
-            vol.Optional(CONF_MANAGE_QUEUES, default=False): cv.boolean,
-            vol.Optional(CONF_CUSTOM_SWITCHES, default=[]): vol.All()
-        })
-    }, extra=vol.ALLOW_EXTRA)
-except Exception as e:
-    _LOGGER.info(f"Exception while setting up input - {type(e)}  {e.args}")
-
-
-def setup(hass, config):
+CUSTOM_SWITCH_COMMAND_SCHEMA = vol.Schema({
+    vol.Required(CONF_CMD): cv.string,
+    vol.Optional(CONF_ARGS): cv.string
+})
+
+CUSTOM_SWITCH_SCHEMA = vol.Schema({
+    vol.Required(CONF_NAME): cv.string,
+    vol.Required(CONF_TURN_ON): CUSTOM_SWITCH_COMMAND_SCHEMA,
+    vol.Required(CONF_TURN_OFF): CUSTOM_SWITCH_COMMAND_SCHEMA,
+    vol.Required(CONF_STATE): CUSTOM_SWITCH_COMMAND_SCHEMA
+})
+
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.All(vol.Schema({
+        vol.Required(CONF_HOST): cv.string,
+        vol.Optional(CONF_USERNAME, default=DEFAULT_USERNAME): cv.string,
+        vol.Optional(CONF_PASSWORD, default=DEFAULT_PASSWORD): cv.string,
+        vol.Optional(CONF_PORT, default=DEFAULT_PORT): cv.port,
+        vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
+        vol.Optional(CONF_SCAN_INTERVAL, default=DEFAULT_SCAN_INTERVAL): cv.time_period,
+        vol.Optional(CONF_MIN_INTERVAL): cv.time_period,
+        vol.Optional(CONF_MAX_INTERVAL): cv.time_period,
+        vol.Optional(CONF_TRAFFIC_UNIT, default=DEFAULT_TRAFFIC_UNIT): vol.In(AVAILABLE_TRAFFIC_UNITS),
+        vol.Optional(CONF_EXPAND_NETWORK_HOSTS, default=False): cv.boolean,
+        vol.Optional(CONF_MONITORED_TRAFFIC, default=['active']): vol.All(cv.ensure_list, [vol.In(AVAILABLE_MONITORED_TRAFFIC)]),
+        vol.Optional(CONF_MONITORED_ADDRESSES, default=[]): cv.ensure_list,
+        vol.Optional(CONF_MANAGE_QUEUES, default=False): cv.boolean,
+        vol.Optional(CONF_HOSTS_REFRESH_UPDATES, default=DEFAULT_HOSTS_REFRESH_UPDATES): vol.All(vol.Coerce(int), vol.Range(min=1)),
+        vol.Optional(CONF_CUSTOM_SWITCHES, default=[]): vol.All(cv.ensure_list, [CUSTOM_SWITCH_SCHEMA])
+    }), _validate_intervals)
+}, extra=vol.ALLOW_EXTRA)
+
+
+async def async_setup(hass, config):
     """Set up the RouterBoard Component."""
-    host = config[DOMAIN][CONF_HOST]
-    username = config[DOMAIN].get(CONF_USERNAME)
-    password = config[DOMAIN].get(CONF_PASSWORD)
-    port = config[DOMAIN][CONF_PORT]
-    scan_interval = config[DOMAIN][CONF_SCAN_INTERVAL]
-    monitored_addresses = config[DOMAIN][CONF_MONITORED_ADDRESSES]
-    traffic_unit = config[DOMAIN][CONF_TRAFFIC_UNIT]
-    expand_network_hosts = config[DOMAIN][CONF_EXPAND_NETWORK_HOSTS]
-    manage_queues = config[DOMAIN][CONF_MANAGE_QUEUES]
-    custom_switches = config[DOMAIN][CONF_CUSTOM_SWITCHES]
+    cfg = config[DOMAIN]
+    host = cfg[CONF_HOST]
+    name = cfg[CONF_NAME]
+    username = cfg.get(CONF_USERNAME)
+    password = cfg.get(CONF_PASSWORD)
+    port = cfg[CONF_PORT]
+    scan_interval = cfg[CONF_SCAN_INTERVAL]
+    min_interval = cfg[CONF_MIN_INTERVAL].total_seconds()
+    max_interval = cfg[CONF_MAX_INTERVAL].total_seconds()
+    monitored_addresses, monitored_networks = _split_monitored_addresses(cfg[CONF_MONITORED_ADDRESSES])
+    traffic_unit = cfg[CONF_TRAFFIC_UNIT]
+    expand_network_hosts = cfg[CONF_EXPAND_NETWORK_HOSTS]
+    manage_queues = cfg[CONF_MANAGE_QUEUES]
+    hosts_refresh_updates = cfg[CONF_HOSTS_REFRESH_UPDATES]
+    custom_switches = cfg[CONF_CUSTOM_SWITCHES]
 
     from librouteros.exceptions import ConnectionError, LoginError
 
     try:
-        rb_data = hass.data[DATA_ROUTERBOARD] = RouterBoardData(hass, host, port, username, password, traffic_unit)
+        # Connecting and initial queries are blocking, keep them off the event loop
+        rb_data = hass.data[DATA_ROUTERBOARD] = await hass.async_add_executor_job(
+            RouterBoardData, hass, host, port, username, password, traffic_unit, monitored_networks, manage_queues,
+            hosts_refresh_updates)
         _LOGGER.info("Connected to API")
     except ConnectionError:
         _LOGGER.error("Could not establish connection to RouterBoard API")
@@ -115,76 +220,154 @@ def setup(hass, config):
         _LOGGER.error(f"Unknown exception occurred while connecting to RouterBoard API - {type(e)}/{e.args}")
         return False
 
-    rb_data.update()
-
-    def refresh(event_time):
-        """Get the latest data from RouterBoard."""
-        rb_data.update()
+    # Single refresh shared by all entities
+    coordinator = hass.data[DATA_COORDINATOR] = RouterBoardCoordinator(
+        hass, rb_data, name, scan_interval.total_seconds(), min_interval, max_interval)
+    await coordinator.async_refresh()
 
     def run_script(call):
         return rb_data.run_script(call.data.get(CONF_NAME))
 
-    hass.services.register(DOMAIN, SERVICE_COMMAND_NAME, run_script, schema=SERVICE_SCHEMA)
-
-    track_time_interval(hass, refresh, scan_interval)
+    hass.services.async_register(DOMAIN, SERVICE_COMMAND_NAME, run_script, schema=SERVICE_SCHEMA)
 
     sensor_config = {
         'sensor_type': CONST_SENSOR_NETWORK,
-        'client_name': config[DOMAIN][CONF_NAME],
-        'monitored_addresses': config[DOMAIN][CONF_MONITORED_ADDRESSES],
-        'monitored_traffic': config[DOMAIN][CONF_MONITORED_TRAFFIC],
-        'expand_network_hosts': config[DOMAIN][CONF_EXPAND_NETWORK_HOSTS]
+        'client_name': name,
+        'monitored_addresses': monitored_addresses,
+        'monitored_traffic': cfg[CONF_MONITORED_TRAFFIC],
+        'expand_network_hosts': expand_network_hosts
     }
 
-    discovery.load_platform(hass, 'sensor', DOMAIN, sensor_config, config)
+    hass.async_create_task(discovery.async_load_platform(hass, 'sensor', DOMAIN, sensor_config, config))
 
-    if config[DOMAIN][CONF_MANAGE_QUEUES] or config[DOMAIN][CONF_CUSTOM_SWITCHES]:
+    if manage_queues or custom_switches:
         switch_config = {
-            'client_name': config[DOMAIN][CONF_NAME],
-            'manage_queues': config[DOMAIN][CONF_MANAGE_QUEUES],
-            'custom_switches': config[DOMAIN][CONF_CUSTOM_SWITCHES]
+            'client_name': name,
+            'manage_queues': manage_queues,
+            'custom_switches': custom_switches
         }
-        discovery.load_platform(hass, 'switch', DOMAIN, switch_config, config)
+        hass.async_create_task(discovery.async_load_platform(hass, 'switch', DOMAIN, switch_config, config))
 
     return True
 
 
+class RouterBoardCoordinator(DataUpdateCoordinator):
+    """Refresh RouterBoard data once per interval for all entities."""
+
+    def __init__(self, hass, rb_data, name, scan_interval, min_interval, max_interval):
+        self._rb_data = rb_data
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._base_interval = min(max(scan_interval, min_interval), max_interval)
+        if self._base_interval != scan_interval:
+            _LOGGER.warning("Scan interval %ss is outside of [%ss, %ss], using %ss",
+                            scan_interval, min_interval, max_interval, self._base_interval)
+        self._interval = self._base_interval
+        super().__init__(hass, _LOGGER, name=name, update_interval=timedelta(seconds=self._base_interval))
+
+    async def _async_update_data(self):
+        started = monotonic()
+        try:
+            await self._rb_data.async_update()
+        finally:
+            # Slow router, double the interval until updates are quick again, then return to configured interval
+            if monotonic() - started > SCAN_INTERVAL_BACKOFF_RATIO * self._interval:
+                self._interval = min(self._interval * 2, self._max_interval)
+            else:
+                self._interval = max(self._interval / 2, self._base_interval)
+
+            # Next refresh is scheduled after update, jitter keeps refreshes from lining up with other periodic work
+            delay = self._interval + random.uniform(-SCAN_INTERVAL_JITTER, SCAN_INTERVAL_JITTER) * self._interval
+            self.update_interval = timedelta(seconds=min(max(delay, self._min_interval), self._max_interval))
+
+        return self._rb_data.snapshot
+
+
 class RouterBoardData:
     """Get the latest data and update the states."""
 
-    def __init__(self, hass, host, port, username, password, traffic_unit):
+    # Long lived and read by every sensor update, no dynamic attributes
+    __slots__ = ('_hass', 'traffic_unit', '_traffic_unit_multiplier', '_traffic_unit_divisor', '_traffic_unit_digits',
+                 '_api', '_background_api', '_pool',
+                 '_local_networks', '_local_masks', '_hosts', '_host_ints', '_host_addresses',
+                 '_network_hosts_cache', '_network_ranges', '_active_hosts_counts',
+                 '_latest_bytes_count', '_latest_packets_count',
+                 '_monitored_networks', '_network_bytes_totals', '_network_packets_totals',
+                 '_snapshot',
+                 '_queues', '_queues_needed', '_last_run', '_last_interval', '_available_scripts', '_sections_available',
+                 '_updating', '_hosts_tick', '_hosts_refresh_updates', '_raw_responses')
+
+    def __init__(self, hass, host, port, username, password, traffic_unit, monitored_networks, manage_queues,
+                 hosts_refresh_updates):
         """Initialize the data handler."""
         self._hass = hass
 
         self.traffic_unit = traffic_unit
+        # Resolve traffic unit once, bits if 'b' in first two letters of traffic unit
+        self._traffic_unit_multiplier = 8 if 'b' in traffic_unit[:2] else 1
+        self._traffic_unit_divisor, self._traffic_unit_digits = TRAFFIC_UNIT_PREFIXES.get(
+            traffic_unit[:1].upper(), (1, None))
 
         self._api = RouterBoardApi(host, port, username, password)
+        # Second connection used by background worker, so its commands don't wait on the main connection lock
+        self._background_api = RouterBoardApi(host, port, username, password)
+        self._pool = ThreadPoolExecutor(max_workers=1)
 
         self._local_networks = []
+        self._local_masks = ()
         self._hosts = {}
-        self._latest_bytes_count = {}
-        self._latest_packets_count = {}
+        self._host_ints = []  # Sorted integer host addresses
+        self._host_addresses = []  # Host addresses in the same order as _host_ints
+        self._network_hosts_cache = {}
+        self._active_hosts_counts = {}  # Network string to number of bound leases, reset on every lease fetch
+        self._network_ranges = {}  # Network string to (first, last) integer address, kept across lease changes
+        self._latest_bytes_count = defaultdict(lambda: defaultdict(int))
+        self._latest_packets_count = defaultdict(lambda: defaultdict(int))
+        self._monitored_networks = []
+        self._network_bytes_totals = defaultdict(int)
+        self._network_packets_totals = defaultdict(int)
+        self._snapshot = {}
         self._queues = {}
-        self._last_run = 0  # Milliseconds
+        # Queues are only read by queue switches
+        self._queues_needed = manage_queues
+        self._last_run = monotonic_ns()  # Nanoseconds
         self._last_interval = 0  # Seconds
         self._available_scripts = {}
+        self._sections_available = {}
+        self._updating = False
+        self._hosts_tick = 0
+        self._hosts_refresh_updates = hosts_refresh_updates
+        self._raw_responses = {}  # (command, args) to response, reset on every update
 
         self._api.reconnect()
-        self.available = True
+        self._background_api.reconnect()
 
         # TODO ne tu, u sensor
         if not self._is_ip_accounting_enabled():
             raise LookupError
 
         self.init_local_networks()
+        self.init_monitored_networks(monitored_networks)
         # Hit snapshot on init to clear previous accounting data
         self._take_accounting_snapshot()
 
         self.init_scripts()
 
     def run_raw_command(self, command, args):
+        # Command may change what cached commands would return
+        self._raw_responses = {}
         return self._api.run_raw_command(command, args)
 
+    def run_cached_raw_command(self, command, args):
+        """Run read-only raw command, identical commands between two updates share one response."""
+        key = (command, args)
+        response = self._raw_responses.get(key)
+        if response is None:
+            response = self._api.run_raw_command(command, args)
+            if response is not None:
+                self._raw_responses[key] = response
+        return response
+
     def run_script(self, script_name):
         script = self._available_scripts.get(script_name)
         params = {'.id': script.get('.id')}
@@ -202,40 +385,65 @@ class RouterBoardData:
     def get_queue_name(self, queue_id):
         return self._queues[queue_id].get('name')
 
-    def get_queue_limits(self, queue_id):
-        return [self._convert_bits_to_appropriate_unit(limit) for limit in self._queues[queue_id].get('max-limit').split('/')]
-
-    def get_queue_state(self, queue_id):
-        return self._queues[queue_id].get('invalid') is False and self._queues[queue_id].get('disabled') is False
+    def get_queue_snapshot(self, queue_id):
+        """State and [upload, download] limits of queue, read with one lookup. Queues are fetched once per update."""
+        queue = self._queues[queue_id]
+        limits = [self._convert_bits_to_appropriate_unit(limit) for limit in queue.get('max-limit').split('/')]
+        return queue.get('invalid') is False and queue.get('disabled') is False, limits
 
     def set_queue_state(self, queue_id, state):
         params = {'.id': queue_id, 'disabled': not state}
         self._api.run_command("/queue/simple/set", **params)
 
     def get_all_hosts_from_network(self, network):
-        return [x for x in self._hosts.keys() if ipaddress.IPv4Address(x) in ipaddress.IPv4Network(network)]
+        # Host index only changes in _build_host_index, which clears the cache
+        hosts = self._network_hosts_cache.get(network)
+        if hosts is None:
+            first, last = self._get_network_range(network)
+            # Network is a contiguous range in sorted host index
+            start = bisect_left(self._host_ints, first)
+            end = bisect_right(self._host_ints, last)
+            hosts = self._network_hosts_cache[network] = self._host_addresses[start:end]
+        return hosts
+
+    def _get_network_range(self, network):
+        network_range = self._network_ranges.get(network)
+        if network_range is None:
+            ip_network = ipaddress.IPv4Network(network)
+            network_range = self._network_ranges[network] = (int(ip_network.network_address),
+                                                              int(ip_network.broadcast_address))
+        return network_range
+
+    def _build_host_index(self):
+        host_index = []
+        for address in self._hosts:
+            try:
+                host_index.append((_address_to_int(address), address))
+            except (OSError, TypeError):
+                _LOGGER.debug(f"Skipping invalid lease address {address}")
+        host_index.sort()
 
-    def host_exists(self, host):
-        return self._hosts.get(host) is not None
+        self._host_ints = [host_int for host_int, _ in host_index]
+        self._host_addresses = [address for _, address in host_index]
+        self._network_hosts_cache.clear()
 
-    @staticmethod
-    def __current_milliseconds():
-        from time import time
-        return int(round(time() * 1000))
+    def host_exists(self, host):
+        return host in self._hosts
 
     def _is_address_part_of_local_network(self, address):
-        for network in self._local_networks:
-            if address in network:
+        # Address is an integer (see _address_to_int), one AND and set lookup per distinct netmask.
+        # Netmasks are ordered largest network first (see init_local_networks) so the common case returns early
+        for netmask, networks in self._local_masks:
+            if address & netmask in networks:
                 return True
         return False
 
     def _take_accounting_snapshot(self):
         # Takes snapshot of all captured packets and keeps timing of snapshots
         self._api.run_command("/ip/accounting/snapshot/take")
-        current_time = self.__current_milliseconds()
-        interval = current_time - self._last_run
+        current_time = monotonic_ns()
+        self._last_interval = (current_time - self._last_run) / 1e9
         self._last_run = current_time
-        self._last_interval = interval / 1000
         _LOGGER.debug(f"Time between snapshots is {self._last_interval} seconds")
 
     def init_scripts(self):
@@ -247,239 +455,353 @@ class RouterBoardData:
         dhcp_networks = self._api.run_command("/ip/dhcp-server/network/print")
         self._local_networks = [ipaddress.IPv4Network(network.get('address')) for network in dhcp_networks]
 
+        # Group network addresses by netmask as integers, membership check is then plain integer math.
+        # Smaller netmask value means larger network, so ascending order checks largest networks first, most of the
+        # traffic is expected to be there
+        local_masks = {}
+        for network in self._local_networks:
+            local_masks.setdefault(int(network.netmask), set()).add(int(network.network_address))
+        self._local_masks = tuple(sorted(local_masks.items()))
+
+    def init_monitored_networks(self, monitored_networks):
+        # Same layout as local networks, netmask mapped to {network address: monitored network string}
+        monitored_masks = {}
+        for address in monitored_networks:
+            network = ipaddress.IPv4Network(address)
+            monitored_masks.setdefault(int(network.netmask), {})[int(network.network_address)] = address
+        self._monitored_networks = sorted(monitored_masks.items())
+
     def _reset_byte_and_packet_counters(self):
-        self._latest_bytes_count = {}
-        self._latest_packets_count = {}
+        # Counters are defaultdicts, use .get() when reading so lookups don't create empty entries
+        self._latest_bytes_count = defaultdict(lambda: defaultdict(int))
+        self._latest_packets_count = defaultdict(lambda: defaultdict(int))
+        self._network_bytes_totals = defaultdict(int)
+        self._network_packets_totals = defaultdict(int)
+
+    def _update_network_counters(self, local_ip, local_ip_int, traffic_type, bytes_count, packets_count):
+        # Network sensors only account hosts known from DHCP leases
+        if local_ip not in self._hosts:
+            return
+
+        for netmask, networks in self._monitored_networks:
+            network = networks.get(local_ip_int & netmask)
+            if network is None:
+                continue
+
+            key = (network, traffic_type)
+            self._network_bytes_totals[key] += bytes_count
+            self._network_packets_totals[key] += packets_count
 
     def _update_byte_and_packet_counters(self, local_ip, traffic_type, bytes_count, packets_count):
-        if bytes_count > 0:
-            if local_ip not in self._latest_bytes_count:
-                self._latest_bytes_count[local_ip] = {}
-            if traffic_type not in self._latest_bytes_count[local_ip]:
-                self._latest_bytes_count[local_ip][traffic_type] = bytes_count
-            else:
-                self._latest_bytes_count[local_ip][traffic_type] += bytes_count
-
-        if packets_count > 0:
-            if local_ip not in self._latest_packets_count:
-                self._latest_packets_count[local_ip] = {}
+        if bytes_count:
+            self._latest_bytes_count[local_ip][traffic_type] += bytes_count
+        if packets_count:
+            self._latest_packets_count[local_ip][traffic_type] += packets_count
+
+    def _update_hosts(self):
+        # Build host dict from DHCP leases
+        dhcp_leases = self._background_api.run_command("/ip/dhcp-server/lease/print")
+        hosts = {lease.get('address'): lease for lease in dhcp_leases}
+        # Rebuild host index only if leased addresses changed
+        rebuild_host_index = hosts.keys() != self._hosts.keys()
+        self._hosts = hosts
+        if rebuild_host_index:
+            self._build_host_index()
+        # Lease status may change even if addresses didn't
+        self._active_hosts_counts = {}
+        _LOGGER.debug(f"Retrieved {len(self._hosts)} hosts")
+
+    def _update_traffic(self):
+        self._reset_byte_and_packet_counters()
+
+        # Hot loop, runs for every accounting row. Bind attribute lookups to locals once
+        if len(self._local_masks) == 1 and len(self._local_masks[0][1]) == 1:
+            # Typical router with single DHCP network, membership is one AND and compare
+            local_netmask, (local_network, ) = self._local_masks[0]
+
+            def is_local(address):
+                return address & local_netmask == local_network
+        else:
+            is_local = self._is_address_part_of_local_network
+        update_counters = self._update_byte_and_packet_counters
+        update_network_counters = self._update_network_counters
+        log_skipped = _LOGGER.isEnabledFor(logging.DEBUG)
+
+        # Rows are processed as they are read from API, snapshot is never held in memory as a whole
+        rows_count = 0
+        for traffic in self._api.stream_command("/ip/accounting/snapshot/print"):
+            rows_count += 1
+            src = traffic['src-address']
+            dst = traffic['dst-address']
+            src_int = _address_to_int(src)
+            dst_int = _address_to_int(dst)
+
+            bytes_count = int(traffic['bytes'])
+            packets_count = int(traffic['packets'])
+
+            src_local = is_local(src_int)
+            dst_local = is_local(dst_int)
+            if src_local and dst_local:
+                # Local traffic
+                update_counters(src, 'local', bytes_count, packets_count)
+                update_counters(dst, 'local', bytes_count, packets_count)
+                update_network_counters(src, src_int, 'local', bytes_count, packets_count)
+                update_network_counters(dst, dst_int, 'local', bytes_count, packets_count)
+            elif src_local:
+                # Upload traffic
+                update_counters(src, 'upload', bytes_count, packets_count)
+                update_network_counters(src, src_int, 'upload', bytes_count, packets_count)
+            elif dst_local:
+                # Download traffic
+                update_counters(dst, 'download', bytes_count, packets_count)
+                update_network_counters(dst, dst_int, 'download', bytes_count, packets_count)
+            elif log_skipped:
+                _LOGGER.debug(f"Skipping packet from {src} to {dst}")
+
+        self._build_snapshot()
+        _LOGGER.debug(f"Traffic data updated, {rows_count} rows processed")
+
+    def _update_queues(self):
+        queues = self._background_api.run_command("/queue/simple/print")
+        self._queues = {queue.get('.id'): queue for queue in queues}
+        _LOGGER.debug(f"Retrieved {len(self._queues)} queues")
+
+    def _section_done(self, section, description, result):
+        """Record result of one update section, returns False if it failed."""
+        if not isinstance(result, BaseException):
+            self._sections_available[section] = True
+            return True
 
-            if traffic_type not in self._latest_packets_count[local_ip]:
-                self._latest_packets_count[local_ip][traffic_type] = packets_count
-            else:
-                self._latest_packets_count[local_ip][traffic_type] += packets_count
+        self._sections_available[section] = False
+        _LOGGER.warning(f"Unable to retrieve {description} - {type(result)} {result.args}")
+        return False
 
-    def update(self, last_run_failed=False):
-        """Get the latest data from Routerboard instance."""
-        # Use "last_run_failed" to stop reconnecting if something fails two times in a row
-        try:
-            # Get all hosts from DHCP leases, build host dict and collapse all addresses to common network
-            dhcp_leases = self._api.run_command("/ip/dhcp-server/lease/print")
+    def section_available(self, section):
+        return self._sections_available.get(section, False)
 
-            self._hosts = {lease.get('address'): lease for lease in dhcp_leases}
-            _LOGGER.debug(f"Retrieved {len(self._hosts)} hosts")
-            #self.available = True
-        except Exception as e:
-            #self.available = False
-            _LOGGER.warning(f"Unable to retrieve hosts from dhcp leases - {type(e)} {e.args}")
-            try:
-                self._api.reconnect()
-                if not last_run_failed:
-                    self.update(True)
-                return
-            except Exception as e:
-                _LOGGER.warning(f"Error reconnecting API - {type(e)} {e.args}")
+    @property
+    def available(self):
+        # Sensors need both hosts and traffic data
+        return self.section_available(SECTION_HOSTS) and self.section_available(SECTION_ACCOUNTING)
 
-        try:
-            # Take accounting snapshot and retrieve the data
-            self._take_accounting_snapshot()
-            traffic_list = self._api.run_command("/ip/accounting/snapshot/print")
-
-            self._reset_byte_and_packet_counters()
-
-            for traffic in traffic_list:
-                source_ip = ipaddress.ip_address(str(traffic.get('src-address')).strip())
-                destination_ip = ipaddress.ip_address(str(traffic.get('dst-address')).strip())
-
-                bytes_count = int(str(traffic.get('bytes')).strip())
-                packets_count = int(str(traffic.get('packets')).strip())
-
-                if self._is_address_part_of_local_network(source_ip) and self._is_address_part_of_local_network(destination_ip):
-                    # Local traffic
-                    self._update_byte_and_packet_counters(str(source_ip), 'local', bytes_count, packets_count)
-                    self._update_byte_and_packet_counters(str(destination_ip), 'local', bytes_count, packets_count)
-                elif self._is_address_part_of_local_network(source_ip) and not self._is_address_part_of_local_network(destination_ip):
-                    # Upload traffic
-                    self._update_byte_and_packet_counters(str(source_ip), 'upload', bytes_count, packets_count)
-                elif not self._is_address_part_of_local_network(source_ip) and self._is_address_part_of_local_network(destination_ip):
-                    # Download traffic
-                    self._update_byte_and_packet_counters(str(destination_ip), 'download', bytes_count, packets_count)
-                else:
-                    _LOGGER.debug(f"Skipping packet from {source_ip} to {destination_ip}")
-                    continue
-
-            _LOGGER.debug(f"Traffic data updated, {len(traffic_list)} rows processed")
-            #self.available = True
-        except Exception as e:
-            #self.available = False
-            _LOGGER.warning(f"Unable to retrieve accounting data - {type(e)} {e.args}")
-            try:
-                self._api.reconnect()
-                if not last_run_failed:
-                    self.update(True)
-                return
-            except Exception as e:
-                _LOGGER.warning(f"Error reconnecting API - {type(e)} {e.args}")
+    async def async_update(self):
+        """Get the latest data from Routerboard instance."""
+        # Refreshes are chained, but don't queue up executor jobs if update is requested while one is still running
+        if self._updating:
+            _LOGGER.debug("Update already in progress, skipping")
+            return
 
+        self._updating = True
+        self._raw_responses = {}
         try:
-            # Get all queues
-            queues = self._api.run_command("/queue/simple/print")
-            self._queues = {queue.get('.id'): queue for queue in queues}
-            _LOGGER.debug(f"Retrieved {len(self._queues)} queues")
-            # self.available = True
-        except Exception as ex:
-            # self.available = False
-            _LOGGER.warning(f"Unable to retrieve queues - {type(ex)} {ex.args}")
+            await self._async_update()
+        finally:
+            self._updating = False
+
+    async def _async_update(self, last_run_failed=False):
+        # Use "last_run_failed" to retry failed update only once, lost connections are re-established by
+        # RouterBoardApi on next command
+        # librouteros is blocking, API calls run in executor. Leases and queues don't depend on accounting snapshot,
+        # they are fetched over background connection while snapshot is taken over the main one
+        sections = [(SECTION_ACCOUNTING, "accounting snapshot",
+                     self._hass.async_add_executor_job(self._take_accounting_snapshot))]
+        # Leases rarely change, fetch them every few updates or until they are retrieved successfully
+        if self._hosts_tick == 0 or not self.section_available(SECTION_HOSTS):
+            sections.append((SECTION_HOSTS, "hosts from dhcp leases",
+                             self._hass.loop.run_in_executor(self._pool, self._update_hosts)))
+        if not last_run_failed:
+            self._hosts_tick = (self._hosts_tick + 1) % self._hosts_refresh_updates
+        if self._queues_needed:
+            sections.append((SECTION_QUEUES, "queues",
+                             self._hass.loop.run_in_executor(self._pool, self._update_queues)))
+
+        # One failing section doesn't cancel the others
+        results = await asyncio.gather(*(job for _, _, job in sections), return_exceptions=True)
+        succeeded = all([self._section_done(section, description, result)
+                         for (section, description, _), result in zip(sections, results)])
+
+        # Snapshot is retrieved once hosts are known, without fresh snapshot traffic would be wrong anyway
+        if self._sections_available[SECTION_ACCOUNTING]:
             try:
-                self._api.reconnect()
-                if not last_run_failed:
-                    self.update(True)
-                return
+                result = await self._hass.async_add_executor_job(self._update_traffic)
             except Exception as e:
-                _LOGGER.warning(f"Error reconnecting API - {type(e)} {e.args}")
+                result = e
+            succeeded = self._section_done(SECTION_ACCOUNTING, "accounting data", result) and succeeded
 
-        dispatcher_send(self._hass, DATA_UPDATED)
+        if not succeeded and not last_run_failed:
+            await self._async_update(True)
 
     def get_address_name(self, address):
-        try:
-            host = self._hosts[address]
-            return host.get('comment') or host.get('host-name') or host.get('mac-address')
-        except:
+        host = self._hosts.get(address)
+        if host is None:
             return address
+        return host.get('comment') or host.get('host-name') or host.get('mac-address')
 
     def get_address_mac(self, address):
-        try:
-            return self._hosts[address].get('mac-address')
-        except:
+        host = self._hosts.get(address)
+        if host is None:
             return '00:00:00:00:00:00'
+        return host.get('mac-address')
 
-    def _convert_bits_to_appropriate_unit(self, bits_count):
+    @staticmethod
+    def _convert_bits_to_appropriate_unit(bits_count):
         converted = int(bits_count)
-        unit = 'bits/s'
-        if converted >= 1000000:
-            converted = converted / 1000000
-            unit = f'M{unit}'
-        elif converted >= 1000:
-            converted = converted / 1000
-            unit = f'k{unit}'
-
-        return f'{round(converted)}{unit}'
-
-    def _convert_bytes_to_requested_unit(self, bytes_count):
-        converted = bytes_count
-        # Check if bits or bytes (bits if 'b' in first two letters of traffic unit)
-        if 'b' in self.traffic_unit[:2]:
-            converted = converted * 8
+        for threshold, unit in BITS_UNITS:
+            if converted >= threshold:
+                return f'{round(converted / threshold)}{unit}'
 
-        # Handle Kilo and Mega
-        if self.traffic_unit[:1].upper() == 'K':
-            converted = round(converted / 1000, 1)
-        elif self.traffic_unit[:1].upper() == 'M':
-            converted = round(converted / 1000000, 2)
+        return f'{converted}bits/s'
 
-        return converted
-
-    def get_active_hosts_in_network(self, network):
-        return [host for host in self.get_all_hosts_from_network(network) if self.host_is_active(host)]
+    def get_active_hosts_count(self, network):
+        # Counted once per lease fetch instead of on every sensor update
+        count = self._active_hosts_counts.get(network)
+        if count is None:
+            host_is_active = self.host_is_active
+            count = self._active_hosts_counts[network] = sum(
+                1 for host in self.get_all_hosts_from_network(network) if host_is_active(host))
+        return count
 
     def host_is_active(self, address):
-        try:
-            return self._hosts[address].get('status') == 'bound'
-        except:
-            return False
-
-    def get_address_traffic_value(self, address, traffic_type):
-        #if self.host_is_active(address):
-        try:
-            bytes_per_second = round(self._latest_bytes_count[address][traffic_type] / self._last_interval)
-            return self._convert_bytes_to_requested_unit(bytes_per_second)
-        except:
-            return 0
-        #return -1
-
-    def get_address_packet_value(self, address, traffic_type):
-        try:
-            return round(self._latest_packets_count[address][traffic_type] / self._last_interval)
-        except:
-            return 0
-
-    def get_network_traffic_value(self, network, traffic_type):
-        try:
-            value = 0
-            for host in self.get_all_hosts_from_network(network):
-                if host in self._latest_bytes_count and traffic_type in self._latest_bytes_count[host]:
-                    value += self._latest_bytes_count[host][traffic_type]
-
-            bytes_per_second = round(value / self._last_interval)
-            return self._convert_bytes_to_requested_unit(bytes_per_second)
-        except:
-            return 0
-
-    def get_network_packet_value(self, network, traffic_type):
-        try:
-            value = 0
-            for host in self.get_all_hosts_from_network(network):
-                if host in self._latest_packets_count and traffic_type in self._latest_packets_count[host]:
-                    value += self._latest_packets_count[host][traffic_type]
-
-            return round(value / self._last_interval)
-        except:
-            return 0
+        host = self._hosts.get(address)
+        return host is not None and host.get('status') == 'bound'
+
+    def _build_snapshot(self):
+        # Rates for all hosts and monitored networks, computed once per update so sensor reads are a dict lookup.
+        # Keyed by (address, traffic_type) with (traffic rate, packets per second) values, so every sensor gets both
+        # with one lookup. Network addresses never collide with host addresses
+        snapshot = {}
+        interval = self._last_interval
+        if interval > 0:
+            # Bytes per second in requested unit, parameters are resolved in __init__ and bound once here.
+            # Byte units without prefix are not divided and stay integers (round with no digits)
+            multiplier = self._traffic_unit_multiplier
+            divisor = self._traffic_unit_divisor
+            digits = self._traffic_unit_digits
+
+            def convert(bytes_count):
+                return round(round(bytes_count / interval) * multiplier / divisor, digits)
+
+            for address, counters in self._latest_bytes_count.items():
+                packets_counters = self._latest_packets_count.get(address, {})
+                for traffic_type, bytes_count in counters.items():
+                    snapshot[(address, traffic_type)] = (convert(bytes_count),
+                                                         round(packets_counters.get(traffic_type, 0) / interval))
+            packets_totals = self._network_packets_totals
+            for key, bytes_count in self._network_bytes_totals.items():
+                snapshot[key] = (convert(bytes_count), round(packets_totals.get(key, 0) / interval))
+
+        self._snapshot = snapshot
+
+    @property
+    def snapshot(self):
+        """(traffic rate, packets per second) keyed by (address, traffic type), replaced on every update."""
+        return self._snapshot
 
 
 class RouterBoardApi:
+    __slots__ = ('_host', '_port', '_username', '_password', '_api', '_lock', '_reconnect_at', '_reconnect_backoff')
+
     def __init__(self, host, port, username, password):
         self._host = host
         self._port = port
         self._username = username
         self._password = password
         self._api = None
-        self._command_running = False
+        # Single API connection is shared between update cycle and services/switches
+        self._lock = threading.Lock()
+        self._reconnect_at = 0
+        self._reconnect_backoff = RECONNECT_BACKOFF_MIN
 
     def reconnect(self):
         from librouteros import connect
+        from librouteros.exceptions import ConnectionError
         from librouteros.login import login_plain
 
-        self._api = connect(host=self._host, port=self._port, username=self._username, password=self._password, login_methods=(login_plain, ))
+        now = monotonic()
+        if now < self._reconnect_at:
+            raise ConnectionError(f"Not reconnecting to {self._host} for another {self._reconnect_at - now:.0f}s")
 
-    def run_command(self, command, **params):
-        tries = 0
-        while self._command_running:
-            _LOGGER.info("Backing off...")
-            sleep(0.2)
-            tries += 1
-            if tries > 5:
-                _LOGGER.info("Giving up...")
-                return None
+        self._disconnect()
+        try:
+            self._api = connect(host=self._host, port=self._port, username=self._username, password=self._password, login_methods=(login_plain, ))
+        except Exception:
+            # Don't hammer unreachable router on every update, back off exponentially up to max
+            self._reconnect_at = now + self._reconnect_backoff
+            self._reconnect_backoff = min(self._reconnect_backoff * 2, RECONNECT_BACKOFF_MAX)
+            raise
+
+        self._reconnect_at = 0
+        self._reconnect_backoff = RECONNECT_BACKOFF_MIN
+
+    def _disconnect(self):
+        if self._api is None:
+            return
+        try:
+            self._api.close()
+        except Exception:
+            pass
+        self._api = None
+
+    def _call(self, func, *args):
+        """Run func with connection, reconnecting first if it was lost. Must be called with lock held."""
+        if self._api is None:
+            self.reconnect()
+        try:
+            return func(self._api, *args)
+        except Exception as e:
+            if _is_connection_error(e):
+                # Connection is reused as long as it works, mark it lost so next command reconnects
+                self._disconnect()
+            raise
 
-        self._command_running = True
-        res = self._api(cmd=command, **params)
-        self._command_running = False
-        return res
+    def _acquire_lock(self, command):
+        # Command that never ran must not look like an empty response, callers keep their previous state instead
+        if not self._lock.acquire(timeout=COMMAND_LOCK_TIMEOUT):
+            raise TimeoutError(f"Unable to acquire API lock for {command}")
 
+    def run_command(self, command, **params):
+        self._acquire_lock(command)
+        try:
+            return self._call(lambda api: api(cmd=command, **params))
+        finally:
+            self._lock.release()
 
     def run_raw_command(self, command, args):
-        tries = 0
-        while self._command_running:
-            _LOGGER.info("Backing off...")
-            sleep(0.2)
-            tries += 1
-            if tries > 5:
-                _LOGGER.info("Giving up...")
-                return None
-
-
-        self._command_running = True
-        res = self._api.rawCmd(command, args)
-        self._command_running = False
-        return res
+        self._acquire_lock(command)
+        try:
+            # Args are a single optional API word
+            words = (args, ) if args else ()
+            return self._call(lambda api: api.rawCmd(command, *words))
+        finally:
+            self._lock.release()
+
+    def stream_command(self, command, **params):
+        """Run command and yield response rows as they arrive instead of collecting whole response."""
+        self._acquire_lock(command)
+        reply_word = None
+        try:
+            self._call(lambda api: api.protocol.writeSentence(command, *(api.composeWord(key, value) for key, value in params.items())))
+
+            traps = []
+            while reply_word != '!done':
+                reply_word, words = self._api._readSentence()
+                if reply_word == '!trap':
+                    traps.append((reply_word, words))
+                elif words:
+                    yield words
+
+            # Raises TrapError/MultiTrapError same as regular command
+            self._api._trapCheck(traps)
+        except Exception as e:
+            # Connection is in unknown state, don't read from it anymore
+            reply_word = '!done'
+            if _is_connection_error(e):
+                self._disconnect()
+            raise
+        finally:
+            try:
+                # Consumer stopped early, drain remaining response so connection stays usable
+                while reply_word != '!done':
+                    reply_word, _ = self._api._readSentence()
+            finally:
+                self._lock.release()
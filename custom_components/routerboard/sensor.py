@@ -5,13 +5,14 @@ import ipaddress
 from homeassistant.const import STATE_OFF, STATE_ON, STATE_UNKNOWN
 from homeassistant.core import callback
 from homeassistant.components.sensor import ENTITY_ID_FORMAT
-from homeassistant.helpers.dispatcher import async_dispatcher_connect
-from homeassistant.helpers.entity import Entity, async_generate_entity_id
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
-from . import DATA_ROUTERBOARD, DATA_UPDATED, CONST_SENSOR_NETWORK, _is_address_a_network
+from . import DATA_ROUTERBOARD, DATA_COORDINATOR, CONST_SENSOR_NETWORK, _is_address_a_network, _generate_entity_id
 
 _LOGGER = logging.getLogger(__name__)
 
+NO_TRAFFIC = (0, 0)
+
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the RouterBoard sensors."""
@@ -19,55 +20,59 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
         return
 
     rb_api = hass.data[DATA_ROUTERBOARD]
+    coordinator = hass.data[DATA_COORDINATOR]
     client_name = discovery_info['client_name']
 
     _LOGGER.info("Setting up RouterBoard sensor platform")
 
     if discovery_info['sensor_type'] is CONST_SENSOR_NETWORK:
-        requested_addresses = discovery_info['monitored_addresses']
-
         expand_network_hosts = discovery_info['expand_network_hosts']
         monitored_traffic = discovery_info['monitored_traffic']
 
-        # Filter monitored addresses, generate all valid hosts if network is supplied and expand_network_hosts is true.
-        # Also monitor network as a whole
+        # Addresses are already validated by component setup, classification is cached.
+        # Generate all valid hosts if network is supplied and expand_network_hosts is true, also monitor network as a whole
         monitored_addresses = []
-        for address in requested_addresses:
-            try:
-                if _is_address_a_network(address):
-                    _LOGGER.debug(f"Tracking requested network {address}")
-                    monitored_addresses.append(address)
-
-                    if expand_network_hosts:
-                        valid_hosts = rb_api.get_all_hosts_from_network(address)
-                        _LOGGER.debug(f"Adding {len(valid_hosts)} hosts sensors due to requested network {address} expansion")
-                        monitored_addresses.extend(rb_api.get_all_hosts_from_network(address))
-                else:
-                    if rb_api.host_exists(address):
-                        _LOGGER.debug(f"Requested host {address} found, tracking")
-                        monitored_addresses.append(address)
-                    else:
-                        _LOGGER.info(f"Requested host {address} is not found in leases, will not track")
-            except ValueError:
-                _LOGGER.warning(f"Invalid address [{address}] specified. "
-                                f"IPv4 address (192.168.1.1) or IPv4 network (192.168.1.0/24) supported only")
-
-        _LOGGER.info(f"Generating {len(monitored_addresses)} network sensors")
-        _LOGGER.debug(f">>>{monitored_addresses}")
+        for address in discovery_info['monitored_addresses']:
+            if _is_address_a_network(address):
+                _LOGGER.debug("Tracking requested network %s", address)
+                monitored_addresses.append(address)
+
+                if expand_network_hosts:
+                    valid_hosts = rb_api.get_all_hosts_from_network(address)
+                    _LOGGER.debug("Adding %d hosts sensors due to requested network %s expansion",
+                                  len(valid_hosts), address)
+                    monitored_addresses.extend(valid_hosts)
+            elif rb_api.host_exists(address):
+                _LOGGER.debug("Requested host %s found, tracking", address)
+                monitored_addresses.append(address)
+            else:
+                _LOGGER.info("Requested host %s is not found in leases, will not track", address)
 
+        _LOGGER.info("Generating %d network sensors", len(monitored_addresses))
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug(">>>%s", monitored_addresses)
+
+        # Ids of existing entities, new ids are reserved in it as sensors are created (see _generate_entity_id)
+        current_ids = set(hass.states.async_entity_ids())
         dev = []
         for address in monitored_addresses:
             for traffic in monitored_traffic:
-                dev.append(RouterBoardAddressSensor(hass, rb_api, client_name, address, traffic))
+                dev.append(RouterBoardAddressSensor(coordinator, rb_api, client_name, address, traffic, current_ids))
 
-        async_add_entities(dev, True)
+        # State is filled from coordinator data on creation, don't request another refresh
+        async_add_entities(dev)
 
 
-class RouterBoardAddressSensor(Entity):
+class RouterBoardAddressSensor(CoordinatorEntity):
     """Base for a RouterBoard address sensor."""
 
-    def __init__(self, hass, rb_api, client_name, address, sensor_type):
+    # One instance per address and traffic type, Entity base still provides __dict__ for attributes set by HA
+    __slots__ = ('_rb_api', '_client_name', '_address', '_state', '_attributes', '_sensor_type',
+                 '_is_network', '_name', '_unit', '_snapshot_key')
+
+    def __init__(self, coordinator, rb_api, client_name, address, sensor_type, current_ids):
         """Initialize base sensor."""
+        super().__init__(coordinator)
         self._rb_api = rb_api
         self._client_name = client_name
         self._address = address
@@ -77,29 +82,32 @@ class RouterBoardAddressSensor(Entity):
 
         self._sensor_type = sensor_type  # Active, Download, Upload, Local, WAN(Download+Local)
 
-        is_network = _is_address_a_network(self._address)
-        name_type = {'net' if is_network else 'host'}
-        name_suffix = ('active_hosts' if is_network else 'activity') if self._sensor_type == 'active' else self._sensor_type
+        # Identity doesn't change, compute it once instead of in every property read
+        self._is_network = _is_address_a_network(self._address)
+        # Host names come from leases and may change, network names are static
+        self._name = f'Network {self._address} {self._sensor_type.capitalize()}' if self._is_network else None
+        self._unit = None if self._sensor_type == 'active' else self._rb_api.traffic_unit
+        self._snapshot_key = (self._address, self._sensor_type)
+
+        name_type = 'net' if self._is_network else 'host'
+        name_suffix = ('active_hosts' if self._is_network else 'activity') if self._sensor_type == 'active' else self._sensor_type
         entity_name = f'{self._client_name}_{name_type}_{self._address}_{name_suffix}'
 
-        self.entity_id = async_generate_entity_id(ENTITY_ID_FORMAT, entity_name, hass=hass)
+        self.entity_id = _generate_entity_id(ENTITY_ID_FORMAT, entity_name, current_ids)
 
-    async def async_added_to_hass(self):
-        """Handle entity which will be added."""
-        async_dispatcher_connect(
-            self.hass, DATA_UPDATED, self._schedule_immediate_update)
+        self._update_state()
 
     @callback
-    def _schedule_immediate_update(self):
-        self.async_schedule_update_ha_state(True)
+    def _handle_coordinator_update(self):
+        self._update_state()
+        self.async_write_ha_state()
 
     @property
     def name(self):
         """Return the name of the sensor."""
-        if _is_address_a_network(self._address):
-            return f'Network {self._address} {self._sensor_type.capitalize()}'
-        else:
-            return f'{self._rb_api.get_address_name(self._address)}'
+        if self._name is not None:
+            return self._name
+        return f'{self._rb_api.get_address_name(self._address)}'
 
     @property
     def state(self):
@@ -108,50 +116,31 @@ class RouterBoardAddressSensor(Entity):
 
     @property
     def unit_of_measurement(self):
-        if self._sensor_type == 'active':
-            return None
-        return self._rb_api.traffic_unit
+        return self._unit
 
     @property
     def device_state_attributes(self):
         return self._attributes
 
-    @property
-    def should_poll(self):
-        """Return the polling requirement for this sensor."""
-        return False
-
     @property
     def available(self):
         """Could the device be accessed during the last update call."""
         return self._rb_api.available
 
-    def update(self):
-        """Get the latest data from RouterBooard API and updates the state."""
+    def _update_state(self):
+        # Everything is already in memory after coordinator refresh, no API calls or executor jobs here
         try:
             if self._sensor_type == 'active':
-                if _is_address_a_network(self._address):
-                    self._state = len(self._rb_api.get_active_hosts_in_network(self._address))
+                if self._is_network:
+                    self._state = self._rb_api.get_active_hosts_count(self._address)
                 else:
                     self._state = STATE_ON if self._rb_api.host_is_active(self._address) else STATE_OFF
-            else:
-                if _is_address_a_network(self._address):
-                    self._state = self._rb_api.get_network_traffic_value(self._address, self._sensor_type) or 0
-                else:
-                    self._state = self._rb_api.get_address_traffic_value(self._address, self._sensor_type)
-        except Exception as e:
-            _LOGGER.warning(f"Exception occurred while updating sensor [{self._sensor_type}][{self._address}] - {type(e)} {e.args}")
+                return
 
-        # Retrieve attributes for all sensors except 'active'
-        if self._sensor_type == 'active':
-            return
-
-        try:
-            if _is_address_a_network(self._address):
-                pps = self._rb_api.get_network_packet_value(self._address, self._sensor_type) or 0
-            else:
-                pps = self._rb_api.get_address_packet_value(self._address, self._sensor_type) or 0
+            # Rate and packets per second come together, attributes are retrieved for all sensors except 'active'
+            self._state, pps = self.coordinator.data.get(self._snapshot_key, NO_TRAFFIC)
             self._attributes = {'packets_per_second': pps}
-        except Exception as e:
-            _LOGGER.warning(
-                f"Exception occurred while updating sensor attributes [{self._sensor_type}][{self._address}] - {type(e)} {e.args}")
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            # No API calls here, only missing coordinator data (first refresh failed) or malformed network can fail
+            _LOGGER.warning("Exception occurred while updating sensor [%s][%s] - %s %s",
+                            self._sensor_type, self._address, type(e), e.args)
@@ -1,15 +1,21 @@
 """RouterBoard client API."""
 import logging
 
+from homeassistant.const import CONF_NAME
 from homeassistant.core import callback
 from homeassistant.components.switch import ENTITY_ID_FORMAT, SwitchDevice
-from homeassistant.helpers.dispatcher import async_dispatcher_connect
-from homeassistant.helpers.entity import async_generate_entity_id
+from homeassistant.helpers.debounce import Debouncer
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
+from librouteros.exceptions import LibError
 
-from . import DATA_ROUTERBOARD, DATA_UPDATED
+from . import (
+    DATA_ROUTERBOARD, DATA_COORDINATOR, SECTION_QUEUES, CONF_TURN_ON, CONF_TURN_OFF, CONF_STATE, CONF_CMD, CONF_ARGS,
+    _generate_entity_id)
 
 _LOGGER = logging.getLogger(__name__)
 
+REFRESH_COOLDOWN = 1  # Seconds
+
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the RouterBoard switches."""
@@ -19,86 +25,89 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
     _LOGGER.info("Setting up RouterBoard switch platform")
 
     rb_api = hass.data[DATA_ROUTERBOARD]
+    coordinator = hass.data[DATA_COORDINATOR]
     client_name = discovery_info['client_name']
-
-    switches = []
+    # Shared by queue and custom switches so their ids don't collide either
+    current_ids = set(hass.states.async_entity_ids())
 
     if discovery_info['manage_queues']:
         monitored_queues = rb_api.get_queue_list()
-        _LOGGER.info(f"Generating {len(monitored_queues)} queue switches")
-        for queue_id in monitored_queues:
-            switches.append(RouterBoardQueueSwitch(hass, rb_api, client_name, queue_id))
-
-    if discovery_info['custom_switches']:
-        for switch in discovery_info['custom_switches']:
-            try:
-                switch_name = switch['name']
-
-            except KeyError:
-                _LOGGER.warning("Missing 'name' in custom switch configuration!")
-                continue
+        _LOGGER.info("Generating %d queue switches", len(monitored_queues))
+        queue_switches = [RouterBoardQueueSwitch(coordinator, rb_api, client_name, queue_id, current_ids)
+                          for queue_id in monitored_queues]
 
-            try:
-                _LOGGER.info(f"Switch turn on action: {switch['turn_on']['cmd']}")
-                _LOGGER.info(f"Switch turn off action: {switch['turn_off']['cmd']}")
-                _LOGGER.info(f"Switch state action: {switch['state']['cmd']}")
-            except KeyError:
-                _LOGGER.warning(f"Invalid config for {switch_name}!")
-                continue
+        async_add_entities(queue_switches)
 
-            # Wont check for switch['state']['args'], these are optional
+    custom_switches = discovery_info['custom_switches']
+    if custom_switches:
+        # Entries are validated by component CONFIG_SCHEMA
+        _LOGGER.info("Generating %d custom switches", len(custom_switches))
+        async_add_entities([RouterBoardCustomSwitch(hass, coordinator, rb_api, client_name, switch, current_ids)
+                            for switch in custom_switches], True)
 
-            _LOGGER.info(f"Generating custom switch [{switch_name}]")
-            switches.append(RouterBoardCustomSwitch(hass, rb_api, client_name, switch))
 
-    async_add_entities(switches, True)
-
-
-class RouterBoardQueueSwitch(SwitchDevice):
+class RouterBoardQueueSwitch(CoordinatorEntity, SwitchDevice):
     """Base for a RouterBoard Queue Switch."""
 
-    def __init__(self, hass, rb_api, client_name, queue_id):
+    __slots__ = ('_rb_api', '_client_name', '_queue_id', '_name', '_target', '_state', '_attributes', '_revision')
+
+    def __init__(self, coordinator, rb_api, client_name, queue_id, current_ids):
         """Initialize switch."""
+        super().__init__(coordinator)
         self._rb_api = rb_api
         self._client_name = client_name
         self._queue_id = queue_id
 
-        self._name = None
+        # Name and target are queue identity, formatted once instead of on every update
+        self._name = f'{self._rb_api.get_queue_name(self._queue_id)}'
+        # Target may be missing, that must not abort setup of the whole platform
+        self._target = (self._rb_api.get_queue_target(self._queue_id) or '').replace(",", ", ")
         self._state = None
-        self._attributes = {}
+        # Updated in place, HA copies attributes when state is written
+        self._attributes = {'target': self._target, 'download-limit': None, 'upload-limit': None}
+        self._revision = None
 
         entity_name = f'{self._client_name}_queue_{self._rb_api.get_queue_target(self._queue_id)}_{self._queue_id}'
 
-        self.entity_id = async_generate_entity_id(ENTITY_ID_FORMAT, entity_name, hass=hass)
+        self.entity_id = _generate_entity_id(ENTITY_ID_FORMAT, entity_name, current_ids)
 
-    async def async_added_to_hass(self):
-        """Handle entity which will be added."""
-        async_dispatcher_connect(
-            self.hass, DATA_UPDATED, self._schedule_immediate_update)
+        self._update_state()
 
     @callback
-    def _schedule_immediate_update(self):
-        self.async_schedule_update_ha_state(True)
+    def _handle_coordinator_update(self):
+        self._update_state()
+        # Queue counters change on every fetch, but only state, limits and availability are shown, skip writing
+        # state when none of them changed
+        revision = (self._state, self._attributes.get('download-limit'), self._attributes.get('upload-limit'),
+                    self.available)
+        if revision == self._revision:
+            return
+        self._revision = revision
+        self.async_write_ha_state()
 
     @property
     def is_on(self) -> bool:
         return self._state
 
-    def turn_on(self, **kwargs) -> None:
-        try:
-            self._rb_api.set_queue_state(self._queue_id, True)
-            self._schedule_immediate_update()
-        except Exception as e:
-            _LOGGER.warning(
-                f"Exception occurred while turning queue on [{self._queue_id}] - {type(e)} {e.args}")
+    async def async_turn_on(self, **kwargs) -> None:
+        await self._async_set_state(True)
 
-    def turn_off(self, **kwargs) -> None:
+    async def async_turn_off(self, **kwargs) -> None:
+        await self._async_set_state(False)
+
+    async def _async_set_state(self, state):
         try:
-            self._rb_api.set_queue_state(self._queue_id, False)
-            self._schedule_immediate_update()
-        except Exception as e:
-            _LOGGER.warning(
-                f"Exception occurred while turning queue off [{self._queue_id}] - {type(e)} {e.args}")
+            await self.hass.async_add_executor_job(self._rb_api.set_queue_state, self._queue_id, state)
+        except (LibError, OSError) as e:
+            _LOGGER.warning("Exception occurred while turning queue %s [%s] - %s %s",
+                            'on' if state else 'off', self._queue_id, type(e), e.args)
+            return
+
+        # New state is known and next coordinator refresh confirms it. Revision is reset so that refresh is written even
+        # if it brings back the old state
+        self._state = state
+        self._revision = None
+        self.async_write_ha_state()
 
     @property
     def name(self):
@@ -109,74 +118,92 @@ class RouterBoardQueueSwitch(SwitchDevice):
     def device_state_attributes(self):
         return self._attributes
 
-    def update(self):
-        """Get the latest data from RouterBoard API and updates the state."""
-        try:
-            self._state = self._rb_api.get_queue_state(self._queue_id)
-        except Exception as e:
-            _LOGGER.warning(
-                f"Exception occurred while retrieving updating queue state [{self._queue_id}] - {type(e)} {e.args}")
-
-        try:
-            limits = self._rb_api.get_queue_limits(self._queue_id)
-            self._attributes = {'target': ", ".join(self._rb_api.get_queue_target(self._queue_id).split(",")),
-                                'download-limit': limits[1],
-                                'upload-limit': limits[0]}
-        except Exception as e:
-            _LOGGER.warning(
-                f"Exception occurred while retrieving updating queue attributes [{self._queue_id}] - {type(e)} {e.args}")
+    @property
+    def available(self):
+        """Could queues be retrieved during the last update call."""
+        return self._rb_api.section_available(SECTION_QUEUES)
 
+    def _update_state(self):
+        # Queues are already in memory after coordinator refresh, only missing queue or malformed limits can fail
         try:
-            self._name = f'{self._rb_api.get_queue_name(self._queue_id)}'
-        except Exception as e:
+            self._state, (upload_limit, download_limit) = self._rb_api.get_queue_snapshot(self._queue_id)
+            self._attributes['download-limit'] = download_limit
+            self._attributes['upload-limit'] = upload_limit
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
             _LOGGER.warning(
-                f"Exception occurred while retrieving updating queue name [{self._queue_id}] - {type(e)} {e.args}")
+                "Exception occurred while retrieving updating queue state [%s] - %s %s", self._queue_id, type(e), e.args)
 
 
 class RouterBoardCustomSwitch(SwitchDevice):
     """Base for a RouterBoard Custom Switch."""
 
-    def __init__(self, hass, rb_data, client_name, switch_data):
+    __slots__ = ('_coordinator', '_rb_data', '_client_name', '_config', '_name', '_state',
+                 '_turn_on_command', '_turn_off_command', '_state_command', '_refresh_debouncer')
+
+    def __init__(self, hass, coordinator, rb_data, client_name, switch_data, current_ids):
         """Initialize switch."""
+        self._coordinator = coordinator
         self._rb_data = rb_data
         self._client_name = client_name
         self._config = switch_data
 
-        self._name = f"{self._config['name']}"
+        self._name = f"{self._config[CONF_NAME]}"
         self._state = None
+        # (cmd, args) for run_raw_command, resolved once from config. Args are optional
+        self._turn_on_command = (self._config[CONF_TURN_ON][CONF_CMD], self._config[CONF_TURN_ON].get(CONF_ARGS))
+        self._turn_off_command = (self._config[CONF_TURN_OFF][CONF_CMD], self._config[CONF_TURN_OFF].get(CONF_ARGS))
+        self._state_command = (self._config[CONF_STATE][CONF_CMD], self._config[CONF_STATE].get(CONF_ARGS))
 
-        entity_name = f"{self._client_name}_switch_{self._config.get('name')}"
+        entity_name = f"{self._client_name}_switch_{self._name}"
 
-        self.entity_id = async_generate_entity_id(ENTITY_ID_FORMAT, entity_name, hass=hass)
+        self.entity_id = _generate_entity_id(ENTITY_ID_FORMAT, entity_name, current_ids)
+
+        # Coordinator retries and quick successive refreshes can request state at about the same time, first request
+        # runs immediately and the rest are coalesced into one more refresh after cooldown
+        self._refresh_debouncer = Debouncer(hass, _LOGGER, cooldown=REFRESH_COOLDOWN, immediate=True,
+                                            function=self._async_refresh_state)
 
     async def async_added_to_hass(self):
         """Handle entity which will be added."""
-        async_dispatcher_connect(
-            self.hass, DATA_UPDATED, self._schedule_immediate_update)
+        # State comes from its own command, refresh it in executor whenever coordinator refreshes
+        self.async_on_remove(self._coordinator.async_add_listener(self._schedule_immediate_update))
+        self.async_on_remove(self._refresh_debouncer.async_cancel)
+
+    async def _async_refresh_state(self):
+        await self.async_update_ha_state(True)
 
     @callback
     def _schedule_immediate_update(self):
-        self.async_schedule_update_ha_state(True)
+        self.hass.async_create_task(self._refresh_debouncer.async_call())
+
+    @property
+    def should_poll(self):
+        """Return the polling requirement for this switch."""
+        return False
 
     @property
     def is_on(self) -> bool:
         return self._state
 
-    def turn_on(self, **kwargs) -> None:
-        try:
-            _LOGGER.info(f"Turning on {self._config['name']}")
-            self._rb_data.run_raw_command(self._config['turn_on']['cmd'], self._config['turn_on'].get('args'))
-            self.async_schedule_update_ha_state(True)
-        except Exception as e:
-            _LOGGER.warning(f"Could not turn on custom switch {self._config['name']} >> {type(e)}  {e.args}")
+    async def async_turn_on(self, **kwargs) -> None:
+        await self._async_set_state(True)
+
+    async def async_turn_off(self, **kwargs) -> None:
+        await self._async_set_state(False)
 
-    def turn_off(self, **kwargs) -> None:
+    async def _async_set_state(self, state):
+        action = 'on' if state else 'off'
+        command = self._turn_on_command if state else self._turn_off_command
         try:
-            _LOGGER.info(f"Turning off {self._config['name']}")
-            self._rb_data.run_raw_command(self._config['turn_off']['cmd'], self._config['turn_off'].get('args'))
-            self.async_schedule_update_ha_state(True)
-        except Exception as e:
-            _LOGGER.warning(f"Could not turn off custom switch {self._config['name']} >> {type(e)}  {e.args}")
+            _LOGGER.info("Turning %s %s", action, self._name)
+            await self.hass.async_add_executor_job(self._rb_data.run_raw_command, *command)
+        except (LibError, OSError) as e:
+            _LOGGER.warning("Could not turn %s custom switch %s >> %s  %s", action, self._name, type(e), e.args)
+            return
+
+        # Assume command worked, next coordinator refresh runs state command and confirms it
+        self._state = state
+        self.async_write_ha_state()
 
     @property
     def name(self):
@@ -186,9 +213,16 @@ class RouterBoardCustomSwitch(SwitchDevice):
     def update(self):
         """Get the latest data from RouterBoard API and updates the state."""
         try:
-            response = self._rb_data.run_raw_command(self._config['state']['cmd'], self._config['state'].get('args'))
-            self._state = all([el.get('invalid') is False and el.get('disabled') is False for el in response])
-        except Exception as e:
-            _LOGGER.warning(f"Could not update custom switch {self._config['name']} >> {type(e)}  {e.args}")
+            # Switches sharing the same state command query router once per coordinator refresh
+            response = self._rb_data.run_cached_raw_command(*self._state_command)
+            # On only if command matched something and every matched item is valid and enabled, stops at first one
+            # that isn't
+            self._state = bool(response) and all(
+                el.get('invalid') is False and el.get('disabled') is False for el in response)
+        except TimeoutError as e:
+            # State command didn't run, nothing is known about current state
+            _LOGGER.debug("Keeping previous state of custom switch %s >> %s", self._name, e.args)
+        except (LibError, OSError) as e:
+            _LOGGER.warning("Could not update custom switch %s >> %s  %s", self._name, type(e), e.args)
             self._state = False
 